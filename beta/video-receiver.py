@@ -2,23 +2,91 @@
 import signal
 from argparse import ArgumentParser
 from collections.abc import Callable
+from contextlib import suppress
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from json import dumps, loads
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import cpu_count
 from pathlib import Path
+from queue import Empty, Queue, SimpleQueue
 from shutil import which
-from subprocess import DEVNULL, PIPE, Popen
+from subprocess import DEVNULL, PIPE, Popen, run
 from sys import exit as exit_program
+from sys import platform
 from tempfile import NamedTemporaryFile
-from threading import Event, Thread
+from threading import Event, Lock, Thread
 from types import FrameType
+from typing import IO, BinaryIO, ClassVar
+
+if platform == "linux":
+  from fcntl import F_SETPIPE_SZ, fcntl
+if platform != "win32":
+  from os import writev
+
+try:
+  from orjson import dumps as _dump_json
+  from orjson import loads
+except ImportError:
+  from json import dumps, loads
+
+  def _dump_json(data: dict) -> bytes:
+    return dumps(data).encode()
+
 
 _INTERFACE_VERSION = 1
 _PORTS = [26282, 42523, 54266, 29095, 42503, 55729, 50431, 56421, 41246, 16171]
+_PROTOCOL_VERSION = "HTTP/1.1"
+_REQUEST_TIMEOUT = 5
+_CHUNK_SIZE = 1 << 20
+_MAX_META_PAYLOAD = 1 << 16
+_ENCODER_THREADS = min(cpu_count() or 1, 16)
+_QUEUED_FRAMES = 3
+_WRITE_BATCH = 64
+_CODECS: dict[str, tuple[str, list[str]]] = {
+  "vp9": (
+    "libvpx-vp9",
+    [
+      "-b:v",
+      "0",
+      "-row-mt",
+      "1",
+      "-tile-columns",
+      "3",
+      "-threads",
+      f"{_ENCODER_THREADS}",
+      "-pix_fmt",
+      "yuva420p",
+    ],
+  ),
+  "vt": ("hevc_videotoolbox", ["-b:v", "20M", "-alpha_quality", "0.75", "-pix_fmt", "bgra"]),
+  "nvenc": ("hevc_nvenc", ["-preset", "p4", "-rc", "vbr", "-cq", "19", "-b:v", "0", "-pix_fmt", "yuv420p"]),
+  "vaapi": ("hevc_vaapi", ["-vaapi_device", "/dev/dri/renderD128", "-vf", "format=nv12,hwupload", "-qp", "20"]),
+}
+_AUTO_CODECS = ("vt", "vp9")
+
+
+def _write_all(fd: int, chunks: list[memoryview]) -> None:
+  views = list(chunks)
+  while views:
+    written = writev(fd, views)
+    while views and written >= len(views[0]):
+      written -= len(views.pop(0))
+    if views:
+      views[0] = views[0][written:]
 
 
 class _VideoEncoder:
-  def __init__(self, path: str, width: int, height: int, fps: int) -> None:
+  def __init__(  # noqa: PLR0913
+    self,
+    path: str,
+    codec: str,
+    *,
+    extra_arguments: list[str],
+    width: int,
+    height: int,
+    fps: int,
+  ) -> None:
+    encoder, arguments = _CODECS[codec]
+    self.size = (width, height)
     with NamedTemporaryFile(delete=False, delete_on_close=False, suffix=".mkv") as file:
       self._name = file.name
       self._encoder = Popen(  # noqa: S603
@@ -26,6 +94,10 @@ class _VideoEncoder:
           path,
           "-hide_banner",
           "-y",
+          "-probesize",
+          "32",
+          "-analyzeduration",
+          "0",
           "-f",
           "rawvideo",
           "-pix_fmt",
@@ -38,23 +110,58 @@ class _VideoEncoder:
           "-",
           "-an",
           "-vcodec",
-          "libvpx-vp9",
-          "-crf",
-          "4",
-          "-b:v",
-          "0",
-          "-pix_fmt",
-          "yuva420p",
+          encoder,
+          *arguments,
+          *extra_arguments,
           file.name,
         ],
+        bufsize=_CHUNK_SIZE if platform == "win32" else -1,
         stdin=PIPE,
         stdout=DEVNULL,
         stderr=DEVNULL,
         close_fds=True,
       )
+      if platform == "linux" and self._encoder.stdin is not None:
+        with suppress(OSError):
+          fcntl(self._encoder.stdin, F_SETPIPE_SZ, _CHUNK_SIZE)
+    chunks_per_frame = -(-width * height * 4 // _CHUNK_SIZE)
+    self._queue: Queue[memoryview | None] = Queue(maxsize=_QUEUED_FRAMES * chunks_per_frame)
+    self._buffers: SimpleQueue[bytearray] = SimpleQueue()
+    self._writer = Thread(target=self._drain, args=(self._encoder.stdin,), daemon=True)
+    self._writer.start()
+
+  def _drain(self, stdin: IO[bytes] | None) -> None:
+    finished = False
+    while not finished:
+      chunks = [self._queue.get()]
+      with suppress(Empty):
+        while len(chunks) < _WRITE_BATCH and chunks[-1] is not None:
+          chunks.append(self._queue.get_nowait())
+      if chunks[-1] is None:
+        chunks.pop()
+        finished = True
+      if not chunks:
+        continue
+      if stdin is not None:
+        try:
+          if platform != "win32":
+            _write_all(stdin.fileno(), chunks)
+          else:
+            for chunk in chunks:
+              stdin.write(chunk)
+        except OSError:
+          stdin = None
+      self._recycle(chunks)
+
+  def _recycle(self, chunks: list[memoryview]) -> None:
+    for chunk in chunks:
+      if isinstance(chunk.obj, bytearray):
+        self._buffers.put(chunk.obj)
 
   def finalize(self) -> str | None:
     if self._encoder is not None:
+      self._queue.put(None)
+      self._writer.join()
       self._encoder.communicate()
       self._encoder = None
       return self._name
@@ -63,29 +170,150 @@ class _VideoEncoder:
   def __del__(self) -> None:
     self.finalize()
 
-  def place_image(self, image: bytes) -> None:
-    if self._encoder is None or self._encoder.stdin is None:
-      return
-    self._encoder.stdin.write(image)
+  def has_room(self, length: int) -> bool:
+    return self._queue.maxsize - self._queue.qsize() >= -(-length // _CHUNK_SIZE)
+
+  def place_image_stream(self, source: BinaryIO, length: int) -> bool:
+    if self._encoder is None:
+      return False
+    # read the whole frame before queueing any of it, so a truncated body never reaches ffmpeg
+    chunks: list[memoryview] = []
+    remaining = length
+    try:
+      while remaining > 0:
+        try:
+          buffer = self._buffers.get_nowait()
+        except Empty:
+          buffer = bytearray(_CHUNK_SIZE)
+        read = source.readinto(memoryview(buffer)[: min(remaining, _CHUNK_SIZE)])
+        chunks.append(memoryview(buffer)[:read])
+        if not read:
+          break
+        remaining -= read
+    finally:
+      if remaining:
+        self._recycle(chunks)
+    if remaining:
+      return False
+    for chunk in chunks:
+      self._queue.put(chunk)
+    return True
+
+
+def _codec_works(ffmpeg_path: str, codec: str, extra_arguments: list[str]) -> bool:
+  encoder, arguments = _CODECS[codec]
+  result = run(  # noqa: S603
+    [
+      ffmpeg_path,
+      "-hide_banner",
+      "-f",
+      "lavfi",
+      "-i",
+      "nullsrc=s=256x256,format=rgba",
+      "-frames:v",
+      "1",
+      "-vcodec",
+      encoder,
+      *arguments,
+      *extra_arguments,
+      "-f",
+      "null",
+      "-",
+    ],
+    stdout=DEVNULL,
+    stderr=DEVNULL,
+    check=False,
+  )
+  return result.returncode == 0
+
+
+def _select_codec(ffmpeg_path: str, requested: str, vp9_arguments: list[str]) -> tuple[str, list[str]] | None:
+  candidates = _AUTO_CODECS if requested == "auto" else (requested,)
+  for codec in candidates:
+    extra_arguments = vp9_arguments if codec == "vp9" else []
+    if _codec_works(ffmpeg_path, codec, extra_arguments):
+      return codec, extra_arguments
+  return None
 
 
-class _Server(HTTPServer):
+class _Server(ThreadingHTTPServer):
   def __init__(
     self,
     server_address: tuple[str, int],
     RequestHandlerClass: Callable[..., BaseHTTPRequestHandler],  # noqa: N803
     ffmpeg_path: str,
+    codec: str,
+    extra_arguments: list[str],
   ) -> None:
     """Forward the arguments and setup encoder state."""
     super().__init__(server_address, RequestHandlerClass)
     self.encoder: _VideoEncoder | None = None
+    self.lock = Lock()
     self._ffmpeg_path = ffmpeg_path
+    self._codec = codec
+    self._extra_arguments = extra_arguments
+
+  @property
+  def max_payload(self) -> int:
+    if self.encoder is None:
+      return _MAX_META_PAYLOAD
+    width, height = self.encoder.size
+    return width * height * 4 * 2 + _MAX_META_PAYLOAD
 
   def create_encoder(self, width: int, height: int, fps: int) -> None:
-    self.encoder = _VideoEncoder(path=self._ffmpeg_path, width=width, height=height, fps=fps)
+    self.encoder = _VideoEncoder(
+      path=self._ffmpeg_path,
+      codec=self._codec,
+      extra_arguments=self._extra_arguments,
+      width=width,
+      height=height,
+      fps=fps,
+    )
+
+
+def _response(status: HTTPStatus, headers: dict[str, str], body: bytes = b"") -> bytes:
+  head = "".join(f"{key}: {value}\r\n" for key, value in headers.items())
+  return f"{_PROTOCOL_VERSION} {status.value} {status.phrase}\r\n{head}\r\n".encode() + body
+
+
+def _json_response(data: dict) -> bytes:
+  body = _dump_json(data)
+  headers = {"Access-Control-Allow-Origin": "*", "Content-Type": "application/json", "Content-Length": f"{len(body)}"}
+  return _response(HTTPStatus.OK, headers, body)
+
+
+_NO_CONTENT = _response(HTTPStatus.NO_CONTENT, {"Access-Control-Allow-Origin": "*"})
+_TOO_MANY_REQUESTS = _response(
+  HTTPStatus.TOO_MANY_REQUESTS,
+  {"Access-Control-Allow-Origin": "*", "Retry-After": "0", "Content-Length": "0"},
+)
+_PREFLIGHT = _response(
+  HTTPStatus.NO_CONTENT,
+  {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, Prefer",
+  },
+)
+_PING_RESPONSE = _json_response({"interface": _INTERFACE_VERSION or -1})
 
 
 class _Handler(BaseHTTPRequestHandler):
+  protocol_version = _PROTOCOL_VERSION
+  timeout = _REQUEST_TIMEOUT
+
+  def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+    _ = format, args
+
+  def _reject_busy(self, encoder: _VideoEncoder, frame_length: int, unread_length: int) -> bool:
+    preferences = {token.strip() for token in self.headers.get("Prefer", "").replace(";", ",").split(",")}
+    if "wait=0" not in preferences or encoder.has_room(frame_length):
+      return False
+    while unread_length > 0 and (chunk := self.rfile.read(min(unread_length, _CHUNK_SIZE))):
+      unread_length -= len(chunk)
+    self.wfile.write(_TOO_MANY_REQUESTS)
+    return True
+
   def _handle_meta(self, data: dict) -> None:
     if not isinstance(self.server, _Server):
       self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
@@ -96,41 +324,53 @@ class _Handler(BaseHTTPRequestHandler):
       return
 
     if method == "ping":
-      self.send_response(HTTPStatus.OK)
-      self.send_header("Access-Control-Allow-Origin", "*")
-      self.send_header("Content-Type", "application/json")
-      self.end_headers()
-      self.wfile.write(dumps({"interface": _INTERFACE_VERSION or -1}).encode())
+      self.wfile.write(_PING_RESPONSE)
       return
 
-    if self.server.encoder is not None:
-      name = self.server.encoder.finalize()
-      self.server.encoder = None
-      if method == "end":
-        self.send_response(HTTPStatus.OK)
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(dumps({"name": name}).encode())
-    if method == "begin":
-      height, width, fps = data["height"], data["width"], data["fps"]
-      self.server.create_encoder(width=width, height=height, fps=fps)
-      self.send_response(HTTPStatus.NO_CONTENT)
-      self.send_header("Access-Control-Allow-Origin", "*")
-      self.end_headers()
+    with self.server.lock:
+      if self.server.encoder is not None:
+        name = self.server.encoder.finalize()
+        self.server.encoder = None
+        if method == "end":
+          self.wfile.write(_json_response({"name": name}))
+      elif method == "end":
+        self.send_error(HTTPStatus.BAD_REQUEST)
+      if method == "begin":
+        height, width, fps = data["height"], data["width"], data["fps"]
+        self.server.create_encoder(width=width, height=height, fps=fps)
+        self.wfile.write(_NO_CONTENT)
 
-  def do_POST(self) -> None:
+  def _handle_json(self, payload_length: int) -> None:
+    self._handle_meta(loads(self.rfile.read(payload_length)))
+
+  def _handle_raw_frame(self, payload_length: int) -> None:
     if not isinstance(self.server, _Server):
       self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
       return
+    with self.server.lock:
+      encoder = self.server.encoder
+      if encoder is None:
+        self.send_error(HTTPStatus.BAD_REQUEST)
+        return
+      width, height = encoder.size
+      if payload_length != width * height * 4:
+        self.send_error(HTTPStatus.BAD_REQUEST)
+        return
+      if self._reject_busy(encoder, payload_length, payload_length):
+        return
+      if not encoder.place_image_stream(self.rfile, payload_length):
+        self.send_error(HTTPStatus.BAD_REQUEST)
+        return
+    self.wfile.write(_NO_CONTENT)
 
-    content_type: str | None = self.headers.get("Content-Type")
-    if content_type is None:
-      self.send_error(HTTPStatus.BAD_REQUEST)
+  def do_POST(self) -> None:
+    if not isinstance(self.server, _Server):
+      self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
       return
 
-    raw_payload_length = self.headers.get("Content-Length")
-    if raw_payload_length is None:
+    headers = self.headers
+    raw_payload_length = headers.get("Content-Length")
+    if "Content-Type" not in headers or raw_payload_length is None:
       self.send_error(HTTPStatus.BAD_REQUEST)
       return
 
@@ -140,44 +380,79 @@ class _Handler(BaseHTTPRequestHandler):
       self.send_error(HTTPStatus.BAD_REQUEST)
       return
 
-    if payload_length <= 0:
+    route = self._routes.get(headers.get_content_type())
+    if route is None or payload_length <= 0:
       self.send_error(HTTPStatus.BAD_REQUEST)
       return
 
-    payload = self.rfile.read(payload_length)
-
-    if content_type == "application/json":
-      self._handle_meta(loads(payload))
-    elif content_type == "application/octet-stream":
-      if self.server.encoder is None:
-        self.send_error(HTTPStatus.BAD_REQUEST)
-        return
-      self.server.encoder.place_image(payload)
-      self.send_response(HTTPStatus.NO_CONTENT)
-      self.send_header("Access-Control-Allow-Origin", "*")
-      self.end_headers()
-    else:
-      self.send_error(HTTPStatus.BAD_REQUEST)
+    if payload_length > self.server.max_payload:
+      self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+      return
+    route(self, payload_length)
 
   def do_OPTIONS(self) -> None:
-    self.send_response(HTTPStatus.NO_CONTENT)
-    self.send_header("Access-Control-Allow-Origin", "*")
-    self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
-    self.send_header("Access-Control-Allow-Headers", "Content-Type")
-    self.end_headers()
+    self.wfile.write(_PREFLIGHT)
+
+  _routes: ClassVar[dict[str, Callable[["_Handler", int], None]]] = {
+    "application/json": _handle_json,
+    "application/octet-stream": _handle_raw_frame,
+  }
 
 
 def _main() -> None:
   parser = ArgumentParser()
   parser.add_argument("--port", default=8020, type=int, help="接受请求的端口号")
   parser.add_argument("--ffmpeg-executable", type=Path, help="ffmpeg 可执行程序的位置")
+  parser.add_argument(
+    "--codec",
+    default="auto",
+    choices=["auto", *_CODECS],
+    help="视频编码器，auto 会依次尝试 vt 与 vp9 并使用第一个可用的；nvenc 与 vaapi 不保留透明通道",  # noqa: RUF001
+  )
+  parser.add_argument(
+    "--crf",
+    default=4,
+    type=int,
+    choices=range(64),
+    metavar="0-63",
+    help="VP9 的质量参数，越小画质越好、文件越大",  # noqa: RUF001
+  )
+  parser.add_argument(
+    "--deadline",
+    default="realtime",
+    choices=["realtime", "good", "best"],
+    help="VP9 的编码模式，realtime 最快，good 与 best 压缩效率更高但慢得多",  # noqa: RUF001
+  )
+  parser.add_argument(
+    "--cpu-used",
+    default=5,
+    type=int,
+    choices=range(-9, 10),
+    metavar="-9-9",
+    help="VP9 的速度档位，越大越快、压缩效率越低；good 与 best 模式下仅支持 -5 至 5",  # noqa: RUF001
+  )
   arguments = parser.parse_args()
+  if arguments.deadline != "realtime" and abs(arguments.cpu_used) > 5:  # noqa: PLR2004
+    parser.error("good 与 best 模式下 --cpu-used 的取值范围为 -5 至 5")
   ffmpeg_binary = which(arguments.ffmpeg_executable or "ffmpeg")
   if ffmpeg_binary is None:
     print(  # noqa: T201
       "程序需要 FFmpeg 进行视频编码，请确认是否已安装并加入 PATH 环境变量。也可以通过命令行参数指定其位置",  # noqa: RUF001
     )
     exit_program()
+  vp9_arguments = [
+    "-crf",
+    f"{arguments.crf}",
+    "-deadline",
+    arguments.deadline,
+    "-cpu-used",
+    f"{arguments.cpu_used}",
+  ]
+  selected = _select_codec(ffmpeg_binary, arguments.codec, vp9_arguments)
+  if selected is None:
+    print(f"无法使用编码器 {arguments.codec}，请确认 FFmpeg 支持该编码器且设备具备相应的硬件")  # noqa: RUF001, T201
+    exit_program()
+  codec, extra_arguments = selected
 
   server = None
   for port in _PORTS:
@@ -186,6 +461,8 @@ def _main() -> None:
         server_address=("localhost", port),
         RequestHandlerClass=_Handler,
         ffmpeg_path=ffmpeg_binary,
+        codec=codec,
+        extra_arguments=extra_arguments,
       )
       break
     except OSError: